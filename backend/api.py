@@ -1,14 +1,31 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
+from contextlib import asynccontextmanager
+import anyio.to_thread
 import uvicorn
+import gzip
 import json
+import orjson
+import ormsgpack
 import os
-from file_system import FileSystem
+import sys
+from file_system import FileSystem, msgpack_map_header
+from fs_store import open_store
+from api_hot import HANDLERS, deep_node_to_json, deep_node_to_msgpack, node_to_dict, unknown_command
 import base64
 
-app = FastAPI(title="File System Simulator API")
+@asynccontextmanager
+async def lifespan(app):
+    # Mutating endpoints are sync and run in the threadpool; raise anyio's default limit of 40
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 100
+    yield
+
+app = FastAPI(title="File System Simulator API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -19,181 +36,242 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize file system
-fs = FileSystem()
+# Compress larger responses (the serialized tree is highly repetitive JSON)
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
+
+# Invalid input reported by the file system (e.g. an unknown allocation strategy)
+@app.exception_handler(ValueError)
+async def value_error_handler(request: Request, exc: ValueError):
+    return ORJSONResponse({"detail": str(exc)}, status_code=400)
+
+# Initialize file system (shared between workers when FS_STORE_PATH points to a SQLite file)
+store = open_store(os.getenv("FS_STORE_PATH"))
 
 # Data models
-class CommandRequest(BaseModel):
+class RequestModel(BaseModel):
+    model_config = {"extra": "ignore", "str_strip_whitespace": False}
+
+class CommandRequest(RequestModel):
     command: str
     args: Optional[str] = ""
 
-class FileSystemNode(BaseModel):
-    name: str
-    type: str
-    size: int
-    children: Optional[List[Any]] = None
-    created: str
-    modified: str
-    permissions: Optional[str] = None
-    file_type: Optional[str] = None
-
-class FileSystemState(BaseModel):
-    root: FileSystemNode
-    current_path: List[str]
-    total_size: int
-    used_size: int
+class BatchCommandRequest(RequestModel):
+    commands: List[CommandRequest]
 
-class CommandResponse(BaseModel):
-    result: str
-    state: FileSystemState
-
-class CreateFileRequest(BaseModel):
+class CreateFileRequest(RequestModel):
     name: str
     content: Optional[str] = ""
     file_type: Optional[str] = None
 
-class CreateDirectoryRequest(BaseModel):
+class CreateDirectoryRequest(RequestModel):
     name: str
 
-class DeleteRequest(BaseModel):
+class DeleteRequest(RequestModel):
     name: str
     recursive: Optional[bool] = False
 
-class PermissionRequest(BaseModel):
+class PermissionRequest(RequestModel):
     name: str
     permissions: str
     owner: Optional[str] = None
 
-# Helper function to convert FileSystem node to dict
-def node_to_dict(node):
-    result = {
-        "name": node.name,
-        "type": node.type,
-        "size": node.size,
-        "created": node.created.isoformat(),
-        "modified": node.modified.isoformat(),
-        "permissions": node.permissions,
-        "file_type": node.file_type
-    }
-    
-    if node.type == "directory" and node.children:
-        result["children"] = [node_to_dict(child) for child in node.children]
-    
-    return result
-
-# Helper function to get current state
-def get_current_state():
-    return {
-        "root": node_to_dict(fs.root),
-        "current_path": fs.current_path,
-        "total_size": fs.total_size,
-        "used_size": fs.used_size
-    }
-
-@app.get("/")
-def read_root():
-    return {"message": "File System Simulator API"}
-
-@app.get("/state")
-def get_state():
-    return get_current_state()
-
-@app.post("/command")
-def execute_command(command_req: CommandRequest):
-    cmd = command_req.command.lower()
-    args = command_req.args
-    
-    result = ""
-    
-    try:
-        if cmd == "ls":
-            result = fs.ls(args)
-        elif cmd == "cd":
-            result = fs.cd(args)
-        elif cmd == "pwd":
-            result = fs.pwd()
-        elif cmd == "mkdir":
-            result = fs.mkdir(args)
-        elif cmd == "touch":
-            parts = args.split()
-            if len(parts) > 1 and parts[1].isdigit():
-                result = fs.touch(parts[0], int(parts[1]))
-            else:
-                result = fs.touch(args)
-        elif cmd == "rm":
-            parts = args.split()
-            if len(parts) > 1 and parts[0] == "-r":
-                result = fs.rm(parts[1], recursive=True)
-            else:
-                result = fs.rm(args)
-        elif cmd == "cat":
-            result = fs.cat(args)
-        elif cmd == "file":
-            result = fs.file_info(args)
-        elif cmd == "df":
-            result = "\n".join(fs.df())
-        elif cmd == "tree":
-            result = "\n".join(fs.tree())
-        elif cmd == "find":
-            parts = args.split()
-            if not parts:
-                result = "find: missing operand"
-            else:
-                name = parts[0]
-                path = parts[1] if len(parts) > 1 else None
-                result = fs.find(name, path)
-        elif cmd == "chmod":
-            parts = args.split()
-            if len(parts) < 2:
-                result = "chmod: missing operand"
-            else:
-                permissions = parts[0]
-                filename = parts[1]
-                result = fs.chmod(filename, permissions)
-        elif cmd == "chown":
-            parts = args.split()
-            if len(parts) < 2:
-                result = "chown: missing operand"
-            else:
-                owner = parts[0]
-                filename = parts[1]
-                result = fs.chown(filename, owner)
-        elif cmd == "help":
-            result = (
-                "Available commands:\n"
-                "  ls [path]          - List directory contents\n"
-                "  cd <path>          - Change directory\n"
-                "  mkdir <name>       - Create directory\n"
-                "  touch <name>       - Create file\n"
-                "  rm [-r] <name>     - Remove file/directory\n"
-                "  cat <file>         - Display file contents\n"
-                "  file <name>        - Show file information\n"
-                "  chmod <perms> <file> - Change file permissions\n"
-                "  chown <owner> <file> - Change file owner\n"
-                "  pwd                - Print working directory\n"
-                "  df                 - Show disk usage\n"
-                "  tree               - Show directory tree\n"
-                "  find <name> [path] - Find files by name\n"
+class NavigateRequest(RequestModel):
+    path: str = ""
+
+class AllocationStrategyRequest(RequestModel):
+    strategy: str = "indexed"
+
+# Commands that can change the state returned to the client
+MUTATING_COMMANDS = {"mkdir", "touch", "rm", "chmod", "chown", "cd"}
+
+# Known command names, interned (the terminal already sends them lowercase)
+_INTERNED_CMDS = frozenset(sys.intern(cmd) for cmd in HANDLERS)
+
+# Helper function to get current state (serialized, cached until the next mutation)
+def get_current_state(fs):
+    if fs._state_dirty:
+        fields = {
+            "current_path": fs.current_path,
+            "total_size": fs.total_size,
+            "used_size": fs.used_size
+        }
+        msgpack_state = None  # Encoded from the JSON on first request
+        try:
+            state = orjson.dumps({"root": node_to_dict(fs.root), **fields})
+        except orjson.JSONEncodeError:
+            # Deeper than orjson's nesting limit: encode both formats without recursion
+            # (orjson.loads is not safe on arbitrarily deep input either)
+            state = b'{"root":' + deep_node_to_json(fs.root) + b"," + orjson.dumps(fields)[1:]
+            msgpack_state = b"".join([
+                msgpack_map_header(len(fields) + 1),
+                ormsgpack.packb("root"),
+                deep_node_to_msgpack(fs.root),
+                *(ormsgpack.packb(key) + ormsgpack.packb(value) for key, value in fields.items())
+            ])
+        fs._state_cache = state
+        fs._state_gzip_cache = None
+        fs._state_msgpack_cache = msgpack_state
+        fs._state_dirty = False
+    return fs._state_cache
+
+# Helper function to get the MessagePack-encoded state, encoded once per state version
+def get_msgpack_state(fs):
+    state = get_current_state(fs)
+    if fs._state_msgpack_cache is None:
+        fs._state_msgpack_cache = ormsgpack.packb(orjson.loads(state))
+    return fs._state_msgpack_cache
+
+# Helper function to check whether the client asked for MessagePack instead of JSON
+def wants_msgpack(http_request):
+    return "msgpack" in http_request.headers.get("accept", "")
+
+# Helper function to get the gzip-compressed state, compressed once per state version
+def get_compressed_state(fs):
+    state = get_current_state(fs)
+    if fs._state_gzip_cache is None:
+        fs._state_gzip_cache = gzip.compress(state, compresslevel=5)
+    return fs._state_gzip_cache
+
+# Helper function to invalidate the cached state after a mutation
+def mark_dirty(fs):
+    fs._state_dirty = True
+    fs._version += 1
+
+# The body format follows the Accept header, so caches must key on it
+VARY_ACCEPT = {"Vary": "Accept"}
+
+# Helper function to build a JSON (or MessagePack) response embedding the cached state
+def state_response(fs, http_request, **fields):
+    if wants_msgpack(http_request):
+        # A map of fields plus "state", with the already encoded state appended as the last value
+        body = [msgpack_map_header(len(fields) + 1)]
+        for key, value in fields.items():
+            body.append(ormsgpack.packb(key))
+            body.append(ormsgpack.packb(value))
+        body.append(ormsgpack.packb("state"))
+        body.append(get_msgpack_state(fs))
+        return Response(content=b"".join(body), media_type="application/msgpack", headers=VARY_ACCEPT)
+    body = orjson.dumps(fields)
+    return Response(
+        content=body[:-1] + b',"state":' + get_current_state(fs) + b"}",
+        media_type="application/json",
+        headers=VARY_ACCEPT
+    )
+
+# Helper function to split a command request into its name, raw arguments and tokens
+def parse_command(command_req):
+    raw = command_req.command
+    cmd = raw if raw in _INTERNED_CMDS else raw.lower()
+    args = command_req.args or ""
+    return cmd, args, args.split(None, 2)
+
+# Helper function to run a terminal command as one write against the store
+def run_mutating_command(handler, args, parts, http_request):
+    with store.write() as fs:
+        try:
+            result = handler(fs, args, parts)
+        finally:
+            mark_dirty(fs)
+        return state_response(fs, http_request, result=result)
+
+
+# Static file type catalogue, serialized once at import time
+FILE_TYPES_JSON = orjson.dumps({
+    "file_types": [
+        {"value": "text", "label": "Text File (.txt, .md, .py)", "extensions": ["txt", "md", "py", "js", "html", "css", "json"]},
+        {"value": "image", "label": "Image File (.jpg, .png, .gif)", "extensions": ["jpg", "jpeg", "png", "gif", "bmp", "svg", "webp"]},
+        {"value": "video", "label": "Video File (.mp4, .avi, .mkv)", "extensions": ["mp4", "avi", "mkv", "mov", "wmv", "flv", "webm"]},
+        {"value": "audio", "label": "Audio File (.mp3, .wav, .flac)", "extensions": ["mp3", "wav", "flac", "aac", "ogg", "m4a"]},
+        {"value": "document", "label": "Document (.pdf, .docx, .xlsx)", "extensions": ["pdf", "doc", "docx", "xls", "xlsx", "ppt", "pptx"]},
+        {"value": "archive", "label": "Archive (.zip, .rar, .7z)", "extensions": ["zip", "rar", "7z", "tar", "gz"]},
+        {"value": "executable", "label": "Executable (.exe, .msi, .deb)", "extensions": ["exe", "msi", "deb", "rpm", "dmg"]},
+    ]
+})
+FILE_TYPES_HEADERS = {"Cache-Control": "public, max-age=86400"}
+
+@app.get("/", response_model=None)
+async def read_root():
+    return ORJSONResponse({"message": "File System Simulator API"})
+
+# Helper function to build the /state headers (weak ETag from the store ID and mutation counter;
+# the ID changes with every new tree, so ETags cached from an earlier backend run never match)
+def state_headers(version, msgpack):
+    etag = f'W/"{store.store_id}-{version}-msgpack"' if msgpack else f'W/"{store.store_id}-{version}"'
+    return {"ETag": etag, "Vary": "Accept, Accept-Encoding"}
+
+# Helper function to answer /state from the store (runs in the threadpool)
+def render_state(request, msgpack):
+    with store.read() as fs:
+        headers = state_headers(fs._version, msgpack)
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+        
+        if msgpack:
+            return Response(content=get_msgpack_state(fs), media_type="application/msgpack", headers=headers)
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            # Already compressed, GZipMiddleware passes responses with Content-Encoding through
+            return Response(
+                content=get_compressed_state(fs),
+                media_type="application/json",
+                headers={**headers, "Content-Encoding": "gzip"}
             )
-        else:
-            result = f"{cmd}: command not found"
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        return Response(content=get_current_state(fs), media_type="application/json", headers=headers)
+
+@app.get("/state", response_model=None)
+async def get_state(request: Request):
+    msgpack = wants_msgpack(request)
+    # Unchanged trees are answered with 304 and no body, on the event loop when the
+    # store knows its version without blocking
+    version = store.peek_version()
+    if version is not None:
+        headers = state_headers(version, msgpack)
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
     
-    return {
-        "result": result,
-        "state": get_current_state()
-    }
-
-@app.get("/reset")
-def reset_filesystem():
-    global fs
-    fs = FileSystem()
-    return {"message": "File system reset", "state": get_current_state()}
-
-@app.post("/create-file")
-def create_file(request: CreateFileRequest):
-    try:
+    # Reading the store waits on writers (and on SQLite), serializing walks the tree
+    return await run_in_threadpool(render_state, request, msgpack)
+
+@app.post("/command", response_model=None)
+def execute_command(command_req: CommandRequest, http_request: Request):
+    cmd, args, parts = parse_command(command_req)
+    handler = HANDLERS.get(cmd)
+    if handler is not None and cmd in MUTATING_COMMANDS:
+        return run_mutating_command(handler, args, parts, http_request)
+    
+    # Read-only commands still wait on writers and tree/find walk the whole tree, so
+    # this endpoint stays in the threadpool
+    with store.read() as fs:
+        result = unknown_command(cmd) if handler is None else handler(fs, args, parts)
+        return state_response(fs, http_request, result=result)
+
+@app.post("/commands", response_model=None)
+def execute_commands(batch_req: BatchCommandRequest, http_request: Request):
+    """Run several commands in order and return the state once at the end"""
+    results = []
+    with store.write() as fs:
+        mutated = False
+        try:
+            for command_req in batch_req.commands:
+                cmd, args, parts = parse_command(command_req)
+                mutated = mutated or cmd in MUTATING_COMMANDS
+                handler = HANDLERS.get(cmd)
+                results.append(unknown_command(cmd) if handler is None else handler(fs, args, parts))
+        finally:
+            if mutated:
+                mark_dirty(fs)
+        
+        return state_response(fs, http_request, results=results)
+
+@app.get("/reset", response_model=None)
+def reset_filesystem(http_request: Request):
+    # The store keeps the version moving forward so clients' ETags from before the reset don't match
+    store.replace(FileSystem())
+    with store.read() as fs:
+        return state_response(fs, http_request, message="File system reset")
+
+@app.post("/create-file", response_model=None)
+def create_file(request: CreateFileRequest, http_request: Request):
+    with store.write() as fs:
         # Calculate size based on content or file type
         if request.content:
             content_size = len(request.content.encode('utf-8'))
@@ -201,111 +279,83 @@ def create_file(request: CreateFileRequest):
         else:
             # Let the file system determine size based on file type
             result = fs.touch(request.name)
+        mark_dirty(fs)
         
-        return {
-            "result": result,
-            "state": get_current_state()
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        return state_response(fs, http_request, result=result)
 
-@app.post("/create-directory")
-def create_directory(request: CreateDirectoryRequest):
-    try:
+@app.post("/create-directory", response_model=None)
+def create_directory(request: CreateDirectoryRequest, http_request: Request):
+    with store.write() as fs:
         result = fs.mkdir(request.name)
-        return {
-            "result": result,
-            "state": get_current_state()
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        mark_dirty(fs)
+        return state_response(fs, http_request, result=result)
 
-@app.post("/delete")
-def delete_item(request: DeleteRequest):
-    try:
+@app.post("/delete", response_model=None)
+def delete_item(request: DeleteRequest, http_request: Request):
+    with store.write() as fs:
         result = fs.rm(request.name, request.recursive)
-        return {
-            "result": result,
-            "state": get_current_state()
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        mark_dirty(fs)
+        return state_response(fs, http_request, result=result)
 
-@app.post("/change-permissions")
-def change_permissions(request: PermissionRequest):
-    try:
-        result = fs.chmod(request.name, request.permissions)
-        
+@app.post("/change-permissions", response_model=None)
+def change_permissions(request: PermissionRequest, http_request: Request):
+    with store.write() as fs:
         # Also change owner if provided
-        if request.owner:
-            owner_result = fs.chown(request.name, request.owner)
-            result += "\n" + owner_result
+        result, owner_result = fs.chmod_chown(request.name, request.permissions, request.owner)
+        mark_dirty(fs)
+        if owner_result is not None:
+            result = "\n".join((result, owner_result))
             
-        return {
-            "result": result,
-            "state": get_current_state()
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-
-@app.post("/navigate")
-def navigate_to_path(request: dict):
-    try:
-        path = request.get("path", "")
-        result = fs.cd(path)
-        return {
-            "result": result,
-            "state": get_current_state()
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-
-@app.get("/file-types")
-def get_file_types():
-    return {
-        "file_types": [
-            {"value": "text", "label": "Text File (.txt, .md, .py)", "extensions": ["txt", "md", "py", "js", "html", "css", "json"]},
-            {"value": "image", "label": "Image File (.jpg, .png, .gif)", "extensions": ["jpg", "jpeg", "png", "gif", "bmp", "svg", "webp"]},
-            {"value": "video", "label": "Video File (.mp4, .avi, .mkv)", "extensions": ["mp4", "avi", "mkv", "mov", "wmv", "flv", "webm"]},
-            {"value": "audio", "label": "Audio File (.mp3, .wav, .flac)", "extensions": ["mp3", "wav", "flac", "aac", "ogg", "m4a"]},
-            {"value": "document", "label": "Document (.pdf, .docx, .xlsx)", "extensions": ["pdf", "doc", "docx", "xls", "xlsx", "ppt", "pptx"]},
-            {"value": "archive", "label": "Archive (.zip, .rar, .7z)", "extensions": ["zip", "rar", "7z", "tar", "gz"]},
-            {"value": "executable", "label": "Executable (.exe, .msi, .deb)", "extensions": ["exe", "msi", "deb", "rpm", "dmg"]},
-        ]
-    }
-
-@app.get("/block-info")
-def get_block_info():
+        return state_response(fs, http_request, result=result)
+
+@app.post("/navigate", response_model=None)
+def navigate_to_path(request: NavigateRequest, http_request: Request):
+    with store.write() as fs:
+        result = fs.cd(request.path)
+        mark_dirty(fs)
+        return state_response(fs, http_request, result=result)
+
+@app.get("/file-types", response_model=None)
+async def get_file_types():
+    return Response(content=FILE_TYPES_JSON, media_type="application/json", headers=FILE_TYPES_HEADERS)
+
+@app.get("/block-info", response_model=None)
+def get_block_info(http_request: Request):
     """Get information about block allocation"""
-    block_info = fs.get_block_info()
-    return {
-        "result": "Block information retrieved",
-        "block_info": block_info,
-        "state": get_current_state()
-    }
-
-@app.get("/file-blocks/{filename}")
-def get_file_blocks(filename: str):
+    with store.read() as fs:
+        block_info = fs.get_block_info()
+        return state_response(fs, http_request, result="Block information retrieved", block_info=block_info)
+
+@app.get("/file-blocks/{filename}", response_model=None)
+def get_file_blocks(filename: str, http_request: Request):
     """Get blocks used by a specific file"""
-    file_blocks = fs.get_file_blocks(filename)
-    return {
-        "result": "File block information retrieved",
-        "file_blocks": file_blocks,
-        "state": get_current_state()
-    }
-
-@app.post("/set-allocation-strategy")
-def set_allocation_strategy(request: dict):
+    with store.read() as fs:
+        file_blocks = fs.get_file_blocks(filename)
+        return state_response(fs, http_request, result="File block information retrieved", file_blocks=file_blocks)
+
+@app.post("/set-allocation-strategy", response_model=None)
+def set_allocation_strategy(request: AllocationStrategyRequest, http_request: Request):
     """Set the allocation strategy for new files"""
-    strategy = request.get("strategy", "indexed")
-    try:
-        result = fs.set_allocation_strategy(strategy)
-        return {
-            "result": result,
-            "state": get_current_state()
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    with store.write() as fs:
+        result = fs.set_allocation_strategy(request.strategy)
+        return state_response(fs, http_request, result=result)
 
 if __name__ == "__main__":
-    uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=True)
+    if os.getenv("DEV"):
+        # Development: autoreload on code changes (single worker)
+        uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=True)
+    else:
+        workers = int(os.getenv("WORKERS", "1"))
+        # Without FS_STORE_PATH the file system lives in process memory and every
+        # worker would hold its own tree
+        if workers > 1 and not os.getenv("FS_STORE_PATH"):
+            sys.exit("WORKERS > 1 requires FS_STORE_PATH, otherwise each worker has its own file system")
+        uvicorn.run(
+            "api:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=workers,
+            loop="auto",  # uvloop when installed
+            http="auto",  # httptools when installed
+            access_log=False
+        )
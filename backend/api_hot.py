@@ -0,0 +1,156 @@
+# Hot paths of the API (state serialization and terminal command dispatch).
+# Kept free of FastAPI imports and fully annotated so the module can be compiled
+# with mypyc (`mypyc api_hot.py`); CPython then imports the built extension in
+# place of this file, with identical behavior.
+from typing import Any, Callable, Dict, List, Tuple
+
+from file_system import FileSystem, FileSystemNode, tree_to_json, tree_to_msgpack
+
+# Files and empty directories serialize without a "children" key
+def _leaf_to_dict(node: FileSystemNode) -> Dict[str, Any]:
+    return {
+        "name": node.name,
+        "type": node.type,
+        "size": node.size,
+        "created": node._created_iso,
+        "modified": node._modified_iso,
+        "permissions": node.permissions,
+        "file_type": node.file_type
+    }
+
+def _dir_to_dict(node: FileSystemNode, children: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "name": node.name,
+        "type": node.type,
+        "size": node.size,
+        "created": node._created_iso,
+        "modified": node._modified_iso,
+        "permissions": node.permissions,
+        "file_type": node.file_type,
+        "children": children
+    }
+
+# Helper function to convert FileSystem node to dict
+# (iterative post-order walk; timestamps use the ISO strings cached on each node)
+def node_to_dict(root: FileSystemNode) -> Dict[str, Any]:
+    result_by_id: Dict[int, Dict[str, Any]] = {}
+    stack: List[Tuple[FileSystemNode, bool]] = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            result_by_id[id(node)] = _dir_to_dict(node, [result_by_id.pop(id(child)) for child in node.children.values()])
+        elif node.children:
+            # Non-empty directory (files have no children): revisit it once its children are converted
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.children.values())
+        else:
+            result_by_id[id(node)] = _leaf_to_dict(node)
+
+    return result_by_id[id(root)]
+
+# The same tree encoded without recursion, for trees deeper than orjson and ormsgpack
+# accept (about 127 directory levels)
+def deep_node_to_json(root: FileSystemNode) -> bytes:
+    encoded: bytes = tree_to_json(root, _leaf_to_dict)
+    return encoded
+
+def deep_node_to_msgpack(root: FileSystemNode) -> bytes:
+    encoded: bytes = tree_to_msgpack(root, _leaf_to_dict)
+    return encoded
+
+HELP_TEXT = (
+    "Available commands:\n"
+    "  ls [path]          - List directory contents\n"
+    "  cd <path>          - Change directory\n"
+    "  mkdir <name>       - Create directory\n"
+    "  touch <name>       - Create file\n"
+    "  rm [-r] <name>     - Remove file/directory\n"
+    "  cat <file>         - Display file contents\n"
+    "  file <name>        - Show file information\n"
+    "  chmod <perms> <file> - Change file permissions\n"
+    "  chown <owner> <file> - Change file owner\n"
+    "  pwd                - Print working directory\n"
+    "  df                 - Show disk usage\n"
+    "  tree               - Show directory tree\n"
+    "  find <name> [path] - Find files by name\n"
+)
+
+# Command handlers, each taking the file system, the raw argument string and its tokens (split at most twice)
+def _do_ls(fs: FileSystem, args: str, parts: List[str]) -> str:
+    return fs.ls(args)
+
+def _do_cd(fs: FileSystem, args: str, parts: List[str]) -> str:
+    return fs.cd(args)
+
+def _do_pwd(fs: FileSystem, args: str, parts: List[str]) -> str:
+    return fs.pwd()
+
+def _do_mkdir(fs: FileSystem, args: str, parts: List[str]) -> str:
+    return fs.mkdir(args)
+
+def _do_touch(fs: FileSystem, args: str, parts: List[str]) -> str:
+    if len(parts) > 1 and parts[1].isdecimal():
+        return fs.touch(parts[0], int(parts[1]))
+    return fs.touch(args)
+
+def _do_rm(fs: FileSystem, args: str, parts: List[str]) -> str:
+    if len(parts) > 1 and parts[0] == "-r":
+        return fs.rm(parts[1], recursive=True)
+    return fs.rm(args)
+
+def _do_cat(fs: FileSystem, args: str, parts: List[str]) -> str:
+    return fs.cat(args)
+
+def _do_file(fs: FileSystem, args: str, parts: List[str]) -> str:
+    return fs.file_info(args)
+
+def _do_df(fs: FileSystem, args: str, parts: List[str]) -> str:
+    return "\n".join(fs.df())
+
+def _do_tree(fs: FileSystem, args: str, parts: List[str]) -> str:
+    return "\n".join(fs.tree())
+
+def _do_find(fs: FileSystem, args: str, parts: List[str]) -> str:
+    if not parts:
+        return "find: missing operand"
+    name = parts[0]
+    path = parts[1] if len(parts) > 1 else None
+    return fs.find(name, path)
+
+def _do_chmod(fs: FileSystem, args: str, parts: List[str]) -> str:
+    if len(parts) < 2:
+        return "chmod: missing operand"
+    permissions = parts[0]
+    filename = parts[1]
+    return fs.chmod(filename, permissions)
+
+def _do_chown(fs: FileSystem, args: str, parts: List[str]) -> str:
+    if len(parts) < 2:
+        return "chown: missing operand"
+    owner = parts[0]
+    filename = parts[1]
+    return fs.chown(filename, owner)
+
+def _do_help(fs: FileSystem, args: str, parts: List[str]) -> str:
+    return HELP_TEXT
+
+# Fallback for names missing from HANDLERS; the message is only built on that path
+def unknown_command(cmd: str) -> str:
+    return f"{cmd}: command not found"
+
+HANDLERS: Dict[str, Callable[[FileSystem, str, List[str]], str]] = {
+    "ls": _do_ls,
+    "cd": _do_cd,
+    "pwd": _do_pwd,
+    "mkdir": _do_mkdir,
+    "touch": _do_touch,
+    "rm": _do_rm,
+    "cat": _do_cat,
+    "file": _do_file,
+    "df": _do_df,
+    "tree": _do_tree,
+    "find": _do_find,
+    "chmod": _do_chmod,
+    "chown": _do_chown,
+    "help": _do_help,
+}
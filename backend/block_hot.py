@@ -0,0 +1,36 @@
+# Hot paths of block allocation (run grouping and bitmap masks).
+# Kept free of FileSystem state and fully annotated so the module can be
+# compiled with mypyc (`mypyc block_hot.py`) like api_hot; CPython then imports
+# the built extension in place of this file, with identical behavior.
+from typing import Iterable, List, Tuple
+
+# Group block numbers into (start, length) runs of consecutive blocks
+def block_runs(blocks: Iterable[int]) -> List[Tuple[int, int]]:
+    runs: List[Tuple[int, int]] = []
+    start = 0
+    length = 0
+    for block in sorted(blocks):
+        if length and block == start + length:
+            length += 1
+        else:
+            if length:
+                runs.append((start, length))
+            start = block
+            length = 1
+    if length:
+        runs.append((start, length))
+    return runs
+
+# Bitmap mask with the bits of every block in the given runs set
+def runs_mask(runs: List[Tuple[int, int]]) -> int:
+    mask = 0
+    for start, length in runs:
+        mask |= ((1 << length) - 1) << start
+    return mask
+
+# Expand a bitmap into a list of booleans (True = used), block 0 first
+def bitmap_to_list(bitmap: int, total_blocks: int) -> List[bool]:
+    bits = bin(bitmap)[:1:-1]
+    result = [bit == "1" for bit in bits]
+    result.extend([False] * (total_blocks - len(result)))
+    return result
@@ -1,134 +1,364 @@
 import os
-import json
+import sys
+import orjson
+import ormsgpack
 import time
 from datetime import datetime
 import random
 import math
+from collections import deque
+from functools import lru_cache
+from itertools import islice
 import random
 from typing import List, Dict, Tuple, Optional, Set
+from sortedcontainers import SortedDict, SortedList
+from block_hot import bitmap_to_list, block_runs, runs_mask
 
 # Block size in bytes
 BLOCK_SIZE = 4096  # 4KB blocks
 # Default allocation strategy
 DEFAULT_ALLOCATION_STRATEGY = "indexed"  # Options: "contiguous", "linked", "indexed"
+# Default permissions and owner of new nodes
+DEFAULT_PERMISSIONS = "rwxr-xr-x"
+DEFAULT_OWNER = "user"
+# Header of MessagePack state files (older state files are plain JSON)
+STATE_FILE_MAGIC = b"FSMP"
+# Write-ahead log kept next to a state file (JSON lines of mutations since its last save)
+WAL_SUFFIX = ".wal"
+# Mutations that change one entry of the current directory (named by their first argument)
+ENTRY_OPS = frozenset(("mkdir", "touch", "rm", "chmod", "chown"))
+# File extensions by file type
+FILE_TYPE_EXTENSIONS = {
+    "text": ['txt', 'md', 'py', 'js', 'html', 'css', 'json', 'xml', 'csv'],
+    "image": ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'svg', 'webp'],
+    "video": ['mp4', 'avi', 'mkv', 'mov', 'wmv', 'flv', 'webm'],
+    "audio": ['mp3', 'wav', 'flac', 'aac', 'ogg', 'm4a'],
+    "document": ['pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx'],
+    "archive": ['zip', 'rar', '7z', 'tar', 'gz'],
+    "executable": ['exe', 'msi', 'deb', 'rpm', 'dmg'],
+}
+# Extension -> file type, built once at import time
+EXTENSION_TO_FILE_TYPE = {ext: file_type for file_type, exts in FILE_TYPE_EXTENSIONS.items() for ext in exts}
+
+# Default file size range (bytes) by file type
+DEFAULT_SIZE_RANGES = {
+    "text": (100, 5000),  # 100B - 5KB
+    "image": (50000, 2000000),  # 50KB - 2MB
+    "video": (5000000, 50000000),  # 5MB - 50MB
+    "audio": (1000000, 10000000),  # 1MB - 10MB
+    "document": (10000, 500000),  # 10KB - 500KB
+    "archive": (100000, 10000000),  # 100KB - 10MB
+    "executable": (1000000, 100000000),  # 1MB - 100MB
+}
+BINARY_SIZE_RANGE = (1000, 50000)  # 1KB - 50KB
+# `df` header and bytes -> MB factor (a power of two, so multiplying is exact)
+DF_HEADER = "Filesystem     Size  Used Avail Use%"
+INV_MB = 1.0 / (1024 * 1024)
+# `tree` connectors and child indents, indexed by whether the entry is the last child
+TREE_BRANCHES = ("├── ", "└── ")
+TREE_INDENTS = ("│   ", "    ")
+# `cat` output for non-text files, by file type
+CAT_TEMPLATES = {
+    "image": "[Image file: {name}]\nType: {file_type}\nSize: {size}\nDimensions: 1920x1080 (simulated)\nFormat: {ext}",
+    "video": "[Video file: {name}]\nType: {file_type}\nSize: {size}\nDuration: 00:05:30 (simulated)\nResolution: 1920x1080\nCodec: H.264",
+    "audio": "[Audio file: {name}]\nType: {file_type}\nSize: {size}\nDuration: 00:03:45 (simulated)\nBitrate: 320 kbps\nFormat: {ext}",
+    "document": "[Document file: {name}]\nType: {file_type}\nSize: {size}\nPages: 15 (simulated)\nFormat: {ext}\nContent: Business document with charts and tables",
+    "archive": "[Archive file: {name}]\nType: {file_type}\nSize: {size}\nCompressed size: {size}\nFiles: 25 (simulated)\nCompression ratio: 65%",
+    "executable": "[Executable file: {name}]\nType: {file_type}\nSize: {size}\nArchitecture: x86_64\nVersion: 1.0.0\nDescription: Sample application",
+}
+CAT_BINARY_TEMPLATE = "[Binary file: {name}]\nType: {file_type}\nSize: {size}\nBinary data cannot be displayed as text"
+
+# Names that can't be reached through a path ("", ".", "..", or containing "/") stay out of the path index
+def _is_indexable(name):
+    return name not in ("", ".", "..") and "/" not in name
+
+@lru_cache(maxsize=4096)
+def format_size(size):
+    """Format file size in human readable format"""
+    if size < 1024:
+        return f"{size}B"
+    elif size < 1024 * 1024:
+        return f"{size/1024:.1f}KB"
+    elif size < 1024 * 1024 * 1024:
+        return f"{size/(1024*1024):.1f}MB"
+    else:
+        return f"{size/(1024*1024*1024):.1f}GB"
+
+def msgpack_map_header(size):
+    """MessagePack header of a map with the given number of entries"""
+    if size < 16:
+        return bytes((0x80 | size,))  # fixmap
+    if size < 0x10000:
+        return b"\xde" + size.to_bytes(2, "big")  # map 16
+    return b"\xdf" + size.to_bytes(4, "big")  # map 32
+
+def msgpack_array_header(size):
+    """MessagePack header of an array with the given number of items"""
+    if size < 16:
+        return bytes((0x90 | size,))  # fixarray
+    if size < 0x10000:
+        return b"\xdc" + size.to_bytes(2, "big")  # array 16
+    return b"\xdd" + size.to_bytes(4, "big")  # array 32
+
+def tree_to_json(root, node_fields):
+    """Encode a node tree as JSON without recursion (orjson stops at 255 nesting levels).
+    
+    node_fields(node) gives a node's own fields; non-empty directories get a trailing
+    "children" list, so the bytes equal orjson.dumps of the nested dicts.
+    """
+    parts = []
+    stack = [root]  # Nodes still to encode, or closing bytes to emit
+    while stack:
+        item = stack.pop()
+        if isinstance(item, bytes):
+            parts.append(item)
+            continue
+            
+        encoded = orjson.dumps(node_fields(item))
+        if not item.children:
+            parts.append(encoded)
+            continue
+            
+        parts.append(encoded[:-1] + b',"children":[')
+        stack.append(b"]}")
+        children = list(item.children.values())
+        for index in range(len(children) - 1, -1, -1):
+            stack.append(children[index])
+            if index:
+                stack.append(b",")
+    return b"".join(parts)
+
+def tree_to_msgpack(root, node_fields):
+    """Encode a node tree as MessagePack without recursion (ormsgpack has the same nesting limit)"""
+    parts = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        fields = node_fields(node)
+        children = node.children
+        parts.append(msgpack_map_header(len(fields) + 1 if children else len(fields)))
+        for key, value in fields.items():
+            parts.append(ormsgpack.packb(key))
+            parts.append(ormsgpack.packb(value))
+        if children:
+            parts.append(ormsgpack.packb("children"))
+            parts.append(msgpack_array_header(len(children)))
+            stack.extend(reversed(children.values()))
+    return b"".join(parts)
+
+class _NodeMeta:
+    """Rarely used node fields, only allocated once one of them leaves its default"""
+    __slots__ = ("permissions", "owner", "content")
+    
+    def __init__(self):
+        self.permissions = DEFAULT_PERMISSIONS
+        self.owner = DEFAULT_OWNER
+        self.content = ""
 
 class FileSystemNode:
-    def __init__(self, name, node_type, parent=None):
-        self.name = name
+    __slots__ = (
+        "name", "type", "size", "parent", "children",
+        "_created", "_created_iso", "_modified", "_modified_iso",
+        "file_type", "blocks", "start_block", "allocation_type", "_meta"
+    )
+    
+    def __init__(self, name, node_type, parent=None, timestamp=None):
+        self.name = sys.intern(name)  # Shared with dict keys and lookups of the same name
         self.type = node_type  # "file" or "directory"
         self.size = 0 if node_type == "directory" else 100  # Default file size
         self.parent = parent
-        self.children = [] if node_type == "directory" else None
-        self.created = datetime.now()
-        self.modified = datetime.now()
-        self.permissions = "rwxr-xr-x"  # Default permissions
-        self.owner = "user"  # Default owner
-        self.content = ""  # File content
+        self.children = {} if node_type == "directory" else None  # Name -> child, in creation order
+        # One clock read and one ISO conversion shared by both timestamps
+        now = timestamp if timestamp is not None else datetime.now()
+        self._created = self._modified = now
+        self._created_iso = self._modified_iso = now.isoformat()
+        self._meta = None  # Permissions, owner and content (defaults until first changed)
         self.file_type = self._detect_file_type(name) if node_type == "file" else None
         # Block allocation information
         self.blocks = []  # List of block numbers used by this file
         self.start_block = None  # Starting block (for contiguous allocation)
         self.allocation_type = DEFAULT_ALLOCATION_STRATEGY
         
+    # Timestamps keep their ISO form alongside, so serializing the tree doesn't reformat them
+    @property
+    def created(self):
+        return self._created
+    
+    @created.setter
+    def created(self, value):
+        self._created = value
+        self._created_iso = value.isoformat()
+    
+    @property
+    def modified(self):
+        return self._modified
+    
+    @modified.setter
+    def modified(self, value):
+        self._modified = value
+        self._modified_iso = value.isoformat()
+    
+    # Cold fields live in _meta; reading them never allocates it. Permissions and
+    # owners repeat across many nodes, so their strings are interned
+    @property
+    def permissions(self):
+        return self._meta.permissions if self._meta is not None else DEFAULT_PERMISSIONS
+    
+    @permissions.setter
+    def permissions(self, value):
+        if self._meta is not None or value != DEFAULT_PERMISSIONS:
+            self._writable_meta().permissions = sys.intern(value)
+    
+    @property
+    def owner(self):
+        return self._meta.owner if self._meta is not None else DEFAULT_OWNER
+    
+    @owner.setter
+    def owner(self, value):
+        if self._meta is not None or value != DEFAULT_OWNER:
+            self._writable_meta().owner = sys.intern(value)
+    
+    @property
+    def content(self):
+        return self._meta.content if self._meta is not None else ""
+    
+    @content.setter
+    def content(self, value):
+        if self._meta is not None or value:
+            self._writable_meta().content = value
+    
+    def _writable_meta(self):
+        if self._meta is None:
+            self._meta = _NodeMeta()
+        return self._meta
+    
+    def add_child(self, child):
+        """Append a child under its name"""
+        self.children[child.name] = child
+    
+    def remove_child(self, name):
+        """Remove the child with the given name"""
+        return self.children.pop(name)
+        
     def _detect_file_type(self, filename):
         """Detect file type based on extension"""
         if '.' not in filename:
             return "text"
             
-        ext = filename.split('.')[-1].lower()
-        
-        # Text files
-        if ext in ['txt', 'md', 'py', 'js', 'html', 'css', 'json', 'xml', 'csv']:
-            return "text"
-        # Images
-        elif ext in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'svg', 'webp']:
-            return "image"
-        # Videos
-        elif ext in ['mp4', 'avi', 'mkv', 'mov', 'wmv', 'flv', 'webm']:
-            return "video"
-        # Audio
-        elif ext in ['mp3', 'wav', 'flac', 'aac', 'ogg', 'm4a']:
-            return "audio"
-        # Documents
-        elif ext in ['pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx']:
-            return "document"
-        # Archives
-        elif ext in ['zip', 'rar', '7z', 'tar', 'gz']:
-            return "archive"
-        # Executables
-        elif ext in ['exe', 'msi', 'deb', 'rpm', 'dmg']:
-            return "executable"
-        else:
-            return "binary"
+        return EXTENSION_TO_FILE_TYPE.get(filename.rpartition('.')[2].lower(), "binary")
     
     def get_default_size_for_type(self):
         """Get default size based on file type"""
-        if self.file_type == "text":
-            return random.randint(100, 5000)  # 100B - 5KB
-        elif self.file_type == "image":
-            return random.randint(50000, 2000000)  # 50KB - 2MB
-        elif self.file_type == "video":
-            return random.randint(5000000, 50000000)  # 5MB - 50MB
-        elif self.file_type == "audio":
-            return random.randint(1000000, 10000000)  # 1MB - 10MB
-        elif self.file_type == "document":
-            return random.randint(10000, 500000)  # 10KB - 500KB
-        elif self.file_type == "archive":
-            return random.randint(100000, 10000000)  # 100KB - 10MB
-        elif self.file_type == "executable":
-            return random.randint(1000000, 100000000)  # 1MB - 100MB
-        else:
-            return random.randint(1000, 50000)  # 1KB - 50KB
+        low, high = DEFAULT_SIZE_RANGES.get(self.file_type, BINARY_SIZE_RANGE)
+        return random.randint(low, high)
         
-    def to_dict(self):
-        result = {
+    def own_dict(self):
+        """The node's fields as saved in state files, without its children"""
+        return {
             "name": self.name,
             "type": self.type,
             "size": self.size,
-            "created": self.created.isoformat(),
-            "modified": self.modified.isoformat(),
+            "created": self._created_iso,
+            "modified": self._modified_iso,
             "permissions": self.permissions,
             "file_type": self.file_type,
-            "owner": getattr(self, 'owner', 'user')  # Default owner
+            "owner": self.owner
         }
+    
+    def to_dict(self):
+        result = self.own_dict()
         
         if self.type == "directory" and self.children:
-            result["children"] = [child.to_dict() for child in self.children]
+            result["children"] = [child.to_dict() for child in self.children.values()]
         
         return result
     
+    def to_record(self):
+        """Flat record of the node's own fields (no parent or children)"""
+        return [
+            self.name, self.type, self.size, self._created_iso, self._modified_iso,
+            self.permissions, self.owner, self.content, self.file_type,
+            self.blocks, self.start_block, self.allocation_type
+        ]
+    
+    @classmethod
+    def from_record(cls, record, parent=None):
+        (name, node_type, size, created, modified, permissions, owner, content,
+         file_type, blocks, start_block, allocation_type) = record
+        node = cls(name, node_type, parent, datetime.fromisoformat(created))
+        node.size = size
+        node.modified = datetime.fromisoformat(modified)
+        node.permissions = permissions
+        node.owner = owner
+        node.content = content
+        node.file_type = sys.intern(file_type) if file_type is not None else None
+        node.blocks = blocks
+        node.start_block = start_block
+        node.allocation_type = sys.intern(allocation_type)
+        return node
+    
     @classmethod
     def from_dict(cls, data, parent=None):
-        node = cls(data["name"], data["type"], parent)
+        root = cls._from_own_dict(data, parent)
+        
+        # Explicit-stack walk, so trees of any depth load
+        stack = [(root, data)]
+        while stack:
+            node, node_data = stack.pop()
+            if node.type == "directory" and "children" in node_data:
+                for child_data in node_data["children"]:
+                    child = cls._from_own_dict(child_data, node)
+                    node.children[child_data["name"]] = child
+                    stack.append((child, child_data))
+                    
+        return root
+    
+    @classmethod
+    def _from_own_dict(cls, data, parent):
+        node = cls(data["name"], data["type"], parent, datetime.fromisoformat(data["created"]))
         node.size = data["size"]
-        node.created = datetime.fromisoformat(data["created"])
         node.modified = datetime.fromisoformat(data["modified"])
-        node.permissions = data.get("permissions", "rwxr-xr-x")
-        node.file_type = data.get("file_type")
-        node.owner = data.get("owner", "user")
-        
-        if node.type == "directory" and "children" in data:
-            node.children = [cls.from_dict(child, node) for child in data["children"]]
-            
+        node.permissions = data.get("permissions", DEFAULT_PERMISSIONS)
+        file_type = data.get("file_type")
+        node.file_type = sys.intern(file_type) if file_type is not None else None
+        node.owner = data.get("owner", DEFAULT_OWNER)
         return node
 
 class FileSystem:
-    def __init__(self, total_size=100000000):  # Default 100MB for better simulation
+    def __init__(self, total_size=100000000, sample_data=True):  # Default 100MB for better simulation
         # Create root directory
         self.root = FileSystemNode("/", "directory")
-        self.current_path = ["/"]
+        self.current_path = ["/"]  # Path components as sent to the client
+        self.current_path_str = "/"
+        self.current_dir_node = self.root
         self.total_size = total_size
         self.used_size = 0
         # Block allocation
         self.total_blocks = math.ceil(total_size / BLOCK_SIZE)
-        self.free_blocks = set(range(self.total_blocks))
-        self.used_blocks = set()
-        self.block_map = {}  # Maps block number to file node
         self.allocation_strategy = DEFAULT_ALLOCATION_STRATEGY  # Default strategy
+        self._allocate_fn = self._allocators()[self.allocation_strategy]  # Bound allocator for the strategy
+        self._reset_blocks()
+        
+        # Serialized state cache (maintained by the API layer)
+        self._state_cache = None
+        self._state_gzip_cache = None
+        self._state_msgpack_cache = None
+        self._state_dirty = True
+        self._version = 0  # Bumped on every mutation (used for ETags)
+        
+        # Canonical absolute path -> node for every node in the tree
+        self._path_index = {"/": self.root}
         
-        # Initialize block bitmap
-        self.block_bitmap = [False] * self.total_blocks  # False = free, True = used
+        # Write-ahead log of mutations since the last save_state (off until enable_wal)
+        self._wal = None
+        self._replay_now = None  # Logged time of the mutation being replayed
         
+        # (method name, directory, name) of every entry changed by a mutation, while a store collects them
+        self._changed_entries = None
+        
+        if not sample_data:
+            return
+            
         # Initialize with some default directories and sample files
         self._mkdir("home")
         self.cd("home")
@@ -142,9 +372,6 @@ class FileSystem:
         self._mkdir("etc")
         self._mkdir("var")
         self._mkdir("tmp")
-        
-        # Calculate initial disk usage
-        self._update_disk_usage()
     
     def _create_sample_files(self):
         """Create sample files for demonstration"""
@@ -177,30 +404,127 @@ class FileSystem:
     def _find_node_by_path(self, path):
         """Find a node by path (absolute or relative)"""
         if not path:
-            return self._get_current_directory()
+            return self.current_dir_node
             
-        # Handle absolute paths
+        # Handle absolute paths (one index lookup unless the path has . or .. parts)
         if path.startswith("/"):
-            parts = [p for p in path.split("/") if p]
-            current = self.root
-        else:
-            # Handle relative paths
-            current_dir = self._get_current_directory()
-            if not current_dir:
-                return None
-                
-            if path == ".":
-                return current_dir
-            elif path == "..":
-                if current_dir == self.root:
-                    return self.root
-                return current_dir.parent
+            node = self._path_index.get(path)
+            if node is not None:
+                return node
                 
             parts = [p for p in path.split("/") if p]
-            current = current_dir
+            if "." not in parts and ".." not in parts:
+                node = self._path_index.get("/" + "/".join(parts))
+                if node is not None:
+                    return node
+            # Walking the tree is the authority, the index only speeds up hits
+            return self._walk_path(self.root, path)
+            
+        # Handle relative paths
+        current_dir = self.current_dir_node
+        if not current_dir:
+            return None
+            
+        if path == ".":
+            return current_dir
+        elif path == "..":
+            if current_dir == self.root:
+                return self.root
+            return current_dir.parent
+            
+        return self._walk_path(current_dir, path)
+    
+    def _node_path(self, node):
+        """Build the canonical absolute path of a node from its parent pointers"""
+        parts = []
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+        return "/" + "/".join(reversed(parts))
+    
+    def _attach(self, parent, child):
+        """Add a child to a directory and to the path index"""
+        parent.add_child(child)
+        if _is_indexable(child.name):
+            parent_path = self._node_path(parent)
+            self._path_index[("" if parent_path == "/" else parent_path) + "/" + child.name] = child
+    
+    def _detach(self, parent, name):
+        """Remove a child from a directory and drop its subtree from the path index"""
+        child = parent.remove_child(name)
+        # Unreachable names were never indexed (and their "path" may be another node's)
+        if not _is_indexable(name):
+            return child
             
-        # Navigate through path parts
-        for part in parts:
+        stack = [(child, self._node_path(parent).rstrip("/") + "/" + name)]
+        while stack:
+            node, node_path = stack.pop()
+            if self._path_index.get(node_path) is node:
+                del self._path_index[node_path]
+            if node.children:
+                stack.extend(
+                    (grandchild, node_path + "/" + grandchild.name)
+                    for grandchild in node.children.values() if _is_indexable(grandchild.name)
+                )
+        return child
+    
+    def _rebuild_path_index(self):
+        """Index every node of the tree by its absolute path (after loading a tree)"""
+        self._path_index = {"/": self.root}
+        stack = [(self.root, "")]
+        while stack:
+            node, node_path = stack.pop()
+            for child in node.children.values() if node.children else ():
+                if _is_indexable(child.name):
+                    child_path = node_path + "/" + child.name
+                    self._path_index[child_path] = child
+                    stack.append((child, child_path))
+    
+    def _reset_blocks(self):
+        """Mark every block free"""
+        self.free_blocks = set(range(self.total_blocks))
+        self.used_blocks = set()
+        self.block_map = {}  # Maps block number to file node
+        
+        # Block bitmap (bit i set = block i used)
+        self.block_bitmap = 0
+        
+        # Free extents (maximal runs of free blocks) indexed by start, end and length
+        self._free_by_start = SortedDict()  # start -> length
+        self._free_by_end = {}  # end (exclusive) -> start
+        self._free_by_len = SortedList()  # (length, start)
+        self._add_free_extent(0, self.total_blocks)
+    
+    def _rebuild_blocks(self):
+        """Rebuild every block structure from the blocks the files hold (after loading a tree)"""
+        self._reset_blocks()
+        block_map = self.block_map
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.type == "file":
+                block_map.update(dict.fromkeys(node.blocks, node))
+            elif node.children:
+                stack.extend(node.children.values())
+                
+        self.free_blocks.difference_update(block_map)
+        self.used_blocks.update(block_map)
+        runs = block_runs(block_map)
+        for start, length in runs:
+            self._reserve_extent(start, length)
+        self.block_bitmap = runs_mask(runs)
+    
+    def _restore(self, root, current_path, used_size):
+        """Install a loaded tree and rebuild the path index and block structures from it"""
+        self.root = root
+        self.used_size = used_size
+        self._rebuild_path_index()
+        self._rebuild_blocks()
+        self._set_current_directory(current_path, self._find_node_by_path("/" + "/".join(current_path[1:])))
+    
+    def _walk_path(self, current, path):
+        """Resolve a path one dentry lookup per part, starting from the given node"""
+        for part in path.split("/"):
             if part == "":
                 continue
             if part == ".":
@@ -214,67 +538,60 @@ class FileSystem:
             if current.type != "directory":
                 return None
                 
-            found = False
-            for child in current.children:
-                if child.name == part:
-                    current = child
-                    found = True
-                    break
-                    
-            if not found:
+            current = current.children.get(part)
+            if current is None:
                 return None
                 
         return current
     
-    def _get_current_directory(self):
-        """Get the current directory node"""
-        return self._find_node_by_path("/" + "/".join(self.current_path[1:]))
+    def _set_current_directory(self, path_parts, node):
+        """Record a new current directory (only cd and load_state move it)"""
+        self.current_path = path_parts
+        self.current_path_str = "/" + "/".join(path_parts[1:])
+        self.current_dir_node = node
+    
+    def _add_size(self, node, delta):
+        """Add a size change to a directory and all its ancestors"""
+        while node is not None:
+            node.size += delta
+            node = node.parent
+        self.used_size = self.root.size
     
-    def _update_disk_usage(self):
-        """Recalculate disk usage"""
-        def calculate_size(node):
+    def _calculate_disk_usage(self):
+        """Recount file sizes over the whole tree (consistency check only, not used by commands)"""
+        total = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
             if node.type == "file":
-                return node.size
-            
-            total = 0
-            if node.children:
-                for child in node.children:
-                    child_size = calculate_size(child)
-                    total += child_size
-            
-            node.size = total
-            return total
-            
-        self.used_size = calculate_size(self.root)
-        return self.used_size
+                total += node.size
+            elif node.children:
+                stack.extend(node.children.values())
+        return total
     
     def _get_absolute_path(self, path=None):
         """Convert relative path to absolute path"""
         if not path or path == ".":
-            return "/" + "/".join(self.current_path[1:])
+            return self.current_path_str
         
         if path.startswith("/"):
             return path
             
         if path == "..":
-            if len(self.current_path) > 1:
-                return "/" + "/".join(self.current_path[1:-1])
-            return "/"
+            return self.current_path_str.rpartition("/")[0] or "/"
             
-        current = "/" + "/".join(self.current_path[1:])
+        current = self.current_path_str
         if current == "/":
             return "/" + path
         return current + "/" + path
     
     def pwd(self):
         """Print working directory"""
-        if len(self.current_path) == 1:
-            return "/"
-        return "/" + "/".join(self.current_path[1:])
+        return self.current_path_str
     
     def ls(self, path=None):
         """List directory contents"""
-        target = self._find_node_by_path(path) if path else self._get_current_directory()
+        target = self._find_node_by_path(path) if path else self.current_dir_node
         
         if not target:
             return f"ls: {path}: No such file or directory"
@@ -284,41 +601,26 @@ class FileSystem:
             
         result = []
         if target.children:
-            for child in target.children:
+            for child in target.children.values():
                 type_char = "d" if child.type == "directory" else "-"
-                size_str = self._format_size(child.size).rjust(10)
+                size_str = format_size(child.size).rjust(10)
                 date_str = child.modified.strftime("%Y-%m-%d %H:%M")
                 file_type = f"[{child.file_type}]" if child.file_type else ""
                 result.append(f"{type_char}{child.permissions} {size_str} {date_str} {child.name} {file_type}")
         
         return "\n".join(result) if result else "Directory is empty"
     
-    def _format_size(self, size):
-        """Format file size in human readable format"""
-        if size < 1024:
-            return f"{size}B"
-        elif size < 1024 * 1024:
-            return f"{size/1024:.1f}KB"
-        elif size < 1024 * 1024 * 1024:
-            return f"{size/(1024*1024):.1f}MB"
-        else:
-            return f"{size/(1024*1024*1024):.1f}GB"
-    
     def cat(self, filename):
         """Display file contents"""
         if not filename:
             return "cat: missing file operand"
             
-        current_dir = self._get_current_directory()
+        current_dir = self.current_dir_node
         if not current_dir:
             return "cat: failed to read file"
             
         # Find the file
-        target_file = None
-        for child in current_dir.children:
-            if child.name == filename:
-                target_file = child
-                break
+        target_file = current_dir.children.get(filename)
                 
         if not target_file:
             return f"cat: {filename}: No such file or directory"
@@ -332,36 +634,26 @@ class FileSystem:
                 return target_file.content
             else:
                 return f"[Text file: {filename}]\nContent: Sample text content for {filename}"
-        elif target_file.file_type == "image":
-            return f"[Image file: {filename}]\nType: {target_file.file_type}\nSize: {self._format_size(target_file.size)}\nDimensions: 1920x1080 (simulated)\nFormat: {filename.split('.')[-1].upper()}"
-        elif target_file.file_type == "video":
-            return f"[Video file: {filename}]\nType: {target_file.file_type}\nSize: {self._format_size(target_file.size)}\nDuration: 00:05:30 (simulated)\nResolution: 1920x1080\nCodec: H.264"
-        elif target_file.file_type == "audio":
-            return f"[Audio file: {filename}]\nType: {target_file.file_type}\nSize: {self._format_size(target_file.size)}\nDuration: 00:03:45 (simulated)\nBitrate: 320 kbps\nFormat: {filename.split('.')[-1].upper()}"
-        elif target_file.file_type == "document":
-            return f"[Document file: {filename}]\nType: {target_file.file_type}\nSize: {self._format_size(target_file.size)}\nPages: 15 (simulated)\nFormat: {filename.split('.')[-1].upper()}\nContent: Business document with charts and tables"
-        elif target_file.file_type == "archive":
-            return f"[Archive file: {filename}]\nType: {target_file.file_type}\nSize: {self._format_size(target_file.size)}\nCompressed size: {self._format_size(target_file.size)}\nFiles: 25 (simulated)\nCompression ratio: 65%"
-        elif target_file.file_type == "executable":
-            return f"[Executable file: {filename}]\nType: {target_file.file_type}\nSize: {self._format_size(target_file.size)}\nArchitecture: x86_64\nVersion: 1.0.0\nDescription: Sample application"
-        else:
-            return f"[Binary file: {filename}]\nType: {target_file.file_type or 'unknown'}\nSize: {self._format_size(target_file.size)}\nBinary data cannot be displayed as text"
+        
+        template = CAT_TEMPLATES.get(target_file.file_type, CAT_BINARY_TEMPLATE)
+        return template.format(
+            name=filename,
+            file_type=target_file.file_type or "unknown",
+            size=format_size(target_file.size),
+            ext=filename.rpartition('.')[2].upper()
+        )
     
     def file_info(self, filename):
         """Show detailed file information"""
         if not filename:
             return "file: missing file operand"
             
-        current_dir = self._get_current_directory()
+        current_dir = self.current_dir_node
         if not current_dir:
             return "file: failed to read file"
             
         # Find the file
-        target_file = None
-        for child in current_dir.children:
-            if child.name == filename:
-                target_file = child
-                break
+        target_file = current_dir.children.get(filename)
                 
         if not target_file:
             return f"file: {filename}: No such file or directory"
@@ -371,7 +663,7 @@ class FileSystem:
         info.append(f"Type: {target_file.type}")
         if target_file.file_type:
             info.append(f"File Type: {target_file.file_type}")
-        info.append(f"Size: {self._format_size(target_file.size)} ({target_file.size} bytes)")
+        info.append(f"Size: {format_size(target_file.size)} ({target_file.size} bytes)")
         info.append(f"Permissions: {target_file.permissions}")
         info.append(f"Created: {target_file.created.strftime('%Y-%m-%d %H:%M:%S')}")
         info.append(f"Modified: {target_file.modified.strftime('%Y-%m-%d %H:%M:%S')}")
@@ -381,25 +673,23 @@ class FileSystem:
             
         return "\n".join(info)
     
+    def _resolve_child(self, name):
+        """Find a node in the current directory by name"""
+        current_dir = self.current_dir_node
+        return current_dir.children.get(name) if current_dir else None
+    
     def chmod(self, name, permissions):
         """Change file permissions"""
+        return self._apply_chmod(self._resolve_child(name), name, permissions)
+    
+    def _apply_chmod(self, target, name, permissions):
+        """Change permissions of an already resolved node"""
         if not name:
             return "chmod: missing operand"
             
         if not permissions:
             return "chmod: missing permissions"
             
-        current_dir = self._get_current_directory()
-        if not current_dir:
-            return "chmod: failed to change permissions"
-            
-        # Find the target
-        target = None
-        for child in current_dir.children:
-            if child.name == name:
-                target = child
-                break
-                
         if not target:
             return f"chmod: cannot access '{name}': No such file or directory"
             
@@ -424,28 +714,23 @@ class FileSystem:
         else:
             return f"chmod: invalid mode: '{permissions}'"
             
-        target.modified = datetime.now()
+        now = self._now()
+        target.modified = now
+        self._log("chmod", now, name, permissions)
         return f"Permissions changed for '{name}' to {target.permissions}"
     
     def chown(self, name, owner):
         """Change file ownership (simulated)"""
+        return self._apply_chown(self._resolve_child(name), name, owner)
+    
+    def _apply_chown(self, target, name, owner):
+        """Change ownership of an already resolved node"""
         if not name:
             return "chown: missing operand"
             
         if not owner:
             return "chown: missing owner"
             
-        current_dir = self._get_current_directory()
-        if not current_dir:
-            return "chown: failed to change ownership"
-            
-        # Find the target
-        target = None
-        for child in current_dir.children:
-            if child.name == name:
-                target = child
-                break
-                
         if not target:
             return f"chown: cannot access '{name}': No such file or directory"
             
@@ -454,52 +739,63 @@ class FileSystem:
             target.owner = "user"
             
         target.owner = owner
-        target.modified = datetime.now()
+        now = self._now()
+        target.modified = now
+        self._log("chown", now, name, owner)
         return f"Owner changed for '{name}' to {owner}"
     
+    def chmod_chown(self, name, permissions, owner=None):
+        """Change permissions and optionally the owner, resolving the target once.
+        
+        Returns a (chmod_result, chown_result) tuple; chown_result is None when no owner is given.
+        """
+        target = self._resolve_child(name)
+        chmod_result = self._apply_chmod(target, name, permissions)
+        chown_result = self._apply_chown(target, name, owner) if owner else None
+        return chmod_result, chown_result
+    
     def cd(self, path):
         """Change directory"""
         if not path:
             # Default to /home/user
-            self.current_path = ["/", "home", "user"]
-            return ""
-            
-        if path == "/":
-            self.current_path = ["/"]
-            return ""
-            
-        target_path = self._get_absolute_path(path)
-        target = self._find_node_by_path(target_path)
-        
-        if not target:
-            return f"cd: {path}: No such file or directory"
-            
-        if target.type != "directory":
-            return f"cd: {path}: Not a directory"
-            
-        # Update current path
-        if target_path == "/":
-            self.current_path = ["/"]
+            self._set_current_directory(["/", "home", "user"], self._find_node_by_path("/home/user"))
+        elif path == "/":
+            self._set_current_directory(["/"], self.root)
         else:
-            self.current_path = [""] + [p for p in target_path.split("/") if p]
+            target_path = self._get_absolute_path(path)
+            target = self._find_node_by_path(target_path)
             
+            if not target:
+                return f"cd: {path}: No such file or directory"
+                
+            if target.type != "directory":
+                return f"cd: {path}: Not a directory"
+                
+            # Update current path
+            if target_path == "/":
+                self._set_current_directory(["/"], self.root)
+            else:
+                self._set_current_directory([""] + [p for p in target_path.split("/") if p], target)
+                
+        # Logged once the move succeeded, as the absolute directory it moved to
+        self._log("cd", None, self.current_path_str)
         return ""
     
     def _mkdir(self, name):
         """Internal mkdir without error messages"""
-        current_dir = self._get_current_directory()
+        current_dir = self.current_dir_node
         if not current_dir:
             return False
             
         # Check if directory already exists
-        for child in current_dir.children:
-            if child.name == name:
-                return False
+        if name in current_dir.children:
+            return False
                 
         # Create new directory
-        new_dir = FileSystemNode(name, "directory", current_dir)
-        current_dir.children.append(new_dir)
-        current_dir.modified = datetime.now()
+        now = datetime.now()
+        new_dir = FileSystemNode(name, "directory", current_dir, now)
+        self._attach(current_dir, new_dir)
+        current_dir.modified = now
         
         return True
     
@@ -508,60 +804,45 @@ class FileSystem:
         if not name:
             return "mkdir: missing operand"
             
-        current_dir = self._get_current_directory()
+        current_dir = self.current_dir_node
         if not current_dir:
             return "mkdir: failed to create directory"
             
         # Check if directory already exists
-        for child in current_dir.children:
-            if child.name == name:
-                return f"mkdir: cannot create directory '{name}': File exists"
+        if name in current_dir.children:
+            return f"mkdir: cannot create directory '{name}': File exists"
                 
         # Create new directory
-        new_dir = FileSystemNode(name, "directory", current_dir)
-        current_dir.children.append(new_dir)
-        current_dir.modified = datetime.now()
+        now = self._now()
+        new_dir = FileSystemNode(name, "directory", current_dir, now)
+        self._attach(current_dir, new_dir)
+        current_dir.modified = now
         
-        self._update_disk_usage()
+        self._log("mkdir", now, name)
         return f"Directory '{name}' created"
     
     def _allocate_blocks(self, file_node, size_needed):
         """Allocate blocks for a file based on the current allocation strategy"""
-        num_blocks_needed = math.ceil(size_needed / BLOCK_SIZE)
-        
-        if num_blocks_needed == 0:
-            num_blocks_needed = 1  # Always allocate at least one block
-            
-        if self.allocation_strategy == "contiguous":
-            return self._allocate_contiguous(file_node, num_blocks_needed)
-        elif self.allocation_strategy == "linked":
-            return self._allocate_linked(file_node, num_blocks_needed)
-        else:  # Default to indexed
-            return self._allocate_indexed(file_node, num_blocks_needed)
+        # Always allocate at least one block (ceiling division in integers)
+        num_blocks_needed = max(1, -(-size_needed // BLOCK_SIZE))
+        return self._allocate_fn(file_node, num_blocks_needed)
+    
+    def _allocators(self):
+        """Allocation methods by strategy name"""
+        return {
+            "contiguous": self._allocate_contiguous,
+            "linked": self._allocate_linked,
+            "indexed": self._allocate_indexed
+        }
     
     def _allocate_contiguous(self, file_node, num_blocks):
         """Allocate contiguous blocks for a file"""
-        # Find a contiguous run of free blocks
-        best_start = None
-        best_run_length = 0
-        current_start = None
-        current_run_length = 0
-        
-        for i in range(self.total_blocks):
-            if i in self.free_blocks:
-                if current_start is None:
-                    current_start = i
-                current_run_length += 1
-                
-                if current_run_length >= num_blocks and (best_start is None or current_run_length < best_run_length):
-                    best_start = current_start
-                    best_run_length = current_run_length
-            else:
-                current_start = None
-                current_run_length = 0
-        
-        if best_start is None:
+        # Best fit: the smallest free extent that can hold the file (lowest start on ties)
+        index = self._free_by_len.bisect_left((num_blocks, -1))
+        if index == len(self._free_by_len):
             raise Exception(f"Not enough contiguous space for file of size {num_blocks * BLOCK_SIZE} bytes")
+        best_start = self._free_by_len[index][1]
+        self._reserve_extent(best_start, num_blocks)
         
         # Allocate the blocks
         allocated_blocks = list(range(best_start, best_start + num_blocks))
@@ -573,8 +854,8 @@ class FileSystem:
         for block in allocated_blocks:
             self.free_blocks.remove(block)
             self.used_blocks.add(block)
-            self.block_bitmap[block] = True
             self.block_map[block] = file_node
+        self.block_bitmap |= ((1 << num_blocks) - 1) << best_start
             
         return allocated_blocks
     
@@ -583,15 +864,9 @@ class FileSystem:
         if len(self.free_blocks) < num_blocks:
             raise Exception(f"Not enough space for file of size {num_blocks * BLOCK_SIZE} bytes")
         
-        # Take random blocks from free blocks
-        allocated_blocks = []
-        for _ in range(num_blocks):
-            block = random.choice(list(self.free_blocks))
-            allocated_blocks.append(block)
-            self.free_blocks.remove(block)
-            self.used_blocks.add(block)
-            self.block_bitmap[block] = True
-            self.block_map[block] = file_node
+        # Take random blocks from free blocks (sampled once, without replacement)
+        allocated_blocks = random.sample(list(self.free_blocks), num_blocks)
+        self._mark_blocks_used(file_node, allocated_blocks)
         
         file_node.blocks = allocated_blocks
         file_node.allocation_type = "linked"
@@ -603,42 +878,90 @@ class FileSystem:
             raise Exception(f"Not enough space for file of size {num_blocks * BLOCK_SIZE} bytes")
         
         # Take blocks from free blocks (can be non-contiguous)
-        available_blocks = list(self.free_blocks)
-        allocated_blocks = available_blocks[:num_blocks]
+        allocated_blocks = list(islice(self.free_blocks, num_blocks))
         
         file_node.blocks = allocated_blocks
         file_node.allocation_type = "indexed"
         
         # Update block tracking
-        for block in allocated_blocks:
-            self.free_blocks.remove(block)
-            self.used_blocks.add(block)
-            self.block_bitmap[block] = True
-            self.block_map[block] = file_node
+        self._mark_blocks_used(file_node, allocated_blocks)
             
         return allocated_blocks
     
+    def _mark_blocks_used(self, file_node, blocks):
+        """Record free blocks as used by a file, updating every block structure in bulk"""
+        self.free_blocks.difference_update(blocks)
+        self.used_blocks.update(blocks)
+        self.block_map.update(dict.fromkeys(blocks, file_node))
+        
+        # Set the bitmap one run of consecutive blocks at a time
+        runs = block_runs(blocks)
+        for start, length in runs:
+            self._reserve_extent(start, length)
+        self.block_bitmap |= runs_mask(runs)
+    
+    def _add_free_extent(self, start, length):
+        self._free_by_start[start] = length
+        self._free_by_end[start + length] = start
+        self._free_by_len.add((length, start))
+    
+    def _remove_free_extent(self, start):
+        length = self._free_by_start.pop(start)
+        del self._free_by_end[start + length]
+        self._free_by_len.remove((length, start))
+        return length
+    
+    def _reserve_extent(self, start, length):
+        """Take a run of free blocks out of the free extent containing it"""
+        extent_start = self._free_by_start.keys()[self._free_by_start.bisect_right(start) - 1]
+        extent_end = extent_start + self._remove_free_extent(extent_start)
+        
+        if start > extent_start:
+            self._add_free_extent(extent_start, start - extent_start)
+        if start + length < extent_end:
+            self._add_free_extent(start + length, extent_end - start - length)
+    
+    def _release_extent(self, start, length):
+        """Return a run of blocks to the free extents, merging it with free neighbours"""
+        end = start + length
+        if start in self._free_by_end:
+            left = self._free_by_end[start]
+            self._remove_free_extent(left)
+            start = left
+        if end in self._free_by_start:
+            end += self._remove_free_extent(end)
+        self._add_free_extent(start, end - start)
+    
     def _free_blocks(self, file_node):
         """Free all blocks used by a file"""
         if not hasattr(file_node, 'blocks') or not file_node.blocks:
             return
             
-        for block in file_node.blocks:
-            if block in self.used_blocks:
-                self.used_blocks.remove(block)
-                self.free_blocks.add(block)
-                self.block_bitmap[block] = False
-                if block in self.block_map:
-                    del self.block_map[block]
-        
+        self._release_blocks(file_node.blocks)
         file_node.blocks = []
         file_node.start_block = None
     
+    def _release_blocks(self, blocks):
+        """Return used blocks to every free-space structure in bulk"""
+        freed = self.used_blocks.intersection(blocks)
+        self.used_blocks.difference_update(freed)
+        self.free_blocks.update(freed)
+        for block in freed:
+            self.block_map.pop(block, None)
+        
+        runs = block_runs(freed)
+        for start, length in runs:
+            self._release_extent(start, length)
+        self.block_bitmap &= ~runs_mask(runs)
+    
     def set_allocation_strategy(self, strategy):
         """Set the allocation strategy for new files"""
-        if strategy not in ["contiguous", "linked", "indexed"]:
+        allocate_fn = self._allocators().get(strategy)
+        if allocate_fn is None:
             raise ValueError("Invalid allocation strategy. Choose from: contiguous, linked, indexed")
         self.allocation_strategy = strategy
+        self._allocate_fn = allocate_fn
+        self._log("set_allocation_strategy", None, strategy)
         return f"Allocation strategy set to {strategy}"
     
     def get_block_info(self):
@@ -648,22 +971,22 @@ class FileSystem:
             "used_blocks": len(self.used_blocks),
             "free_blocks": len(self.free_blocks),
             "block_size": BLOCK_SIZE,
-            "bitmap": self.block_bitmap,
+            "bitmap": self._bitmap_list(),
             "fragmentation_index": self._calculate_fragmentation()
         }
     
+    def _bitmap_list(self):
+        """Expand the block bitmap into a list of booleans (True = used)"""
+        return bitmap_to_list(self.block_bitmap, self.total_blocks)
+    
     def get_file_blocks(self, filename):
         """Get blocks used by a specific file"""
-        current_dir = self._get_current_directory()
+        current_dir = self.current_dir_node
         if not current_dir:
             return "Failed to get current directory"
             
         # Find the file
-        target_file = None
-        for child in current_dir.children:
-            if child.name == filename:
-                target_file = child
-                break
+        target_file = current_dir.children.get(filename)
                 
         if not target_file:
             return f"File '{filename}' not found"
@@ -688,17 +1011,17 @@ class FileSystem:
         if len(self.used_blocks) == 0:
             return 0
             
-        # Count contiguous runs of used blocks
-        runs = 0
-        in_run = False
-        
-        for i in range(self.total_blocks):
-            if i in self.used_blocks:
-                if not in_run:
-                    runs += 1
-                    in_run = True
-            else:
-                in_run = False
+        # Count contiguous runs of used blocks from the free extents: used runs are the
+        # gaps between consecutive free extents, plus one before the first and one
+        # after the last unless those extents touch the ends of the disk
+        if not self._free_by_start:
+            runs = 1
+        else:
+            first_start = self._free_by_start.keys()[0]
+            last_start, last_length = self._free_by_start.peekitem(-1)
+            runs = len(self._free_by_start) - 1
+            runs += first_start > 0
+            runs += last_start + last_length < self.total_blocks
                 
         # Perfect case: all used blocks in one run
         # Worst case: alternating used/free blocks
@@ -716,17 +1039,19 @@ class FileSystem:
         if not name:
             return "touch: missing file operand"
         
-        current_dir = self._get_current_directory()
+        current_dir = self.current_dir_node
         if not current_dir:
             return "touch: failed to create file"
         
         # Check if file already exists
-        for child in current_dir.children:
-            if child.name == name:
-                child.modified = datetime.now()
-                return f"File '{name}' timestamp updated"
+        now = self._now()
+        child = current_dir.children.get(name)
+        if child is not None:
+            child.modified = now
+            self._log("touch", now, name)
+            return f"File '{name}' timestamp updated"
             
-        new_file = FileSystemNode(name, "file", current_dir)
+        new_file = FileSystemNode(name, "file", current_dir, now)
         
         # Calculate file size based on content, type, or default
         if content:
@@ -746,7 +1071,7 @@ class FileSystem:
         
         # Set content for text files if not provided
         if new_file.file_type == "text" and not content:
-            new_file.content = f"Sample content for {name}\nCreated at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            new_file.content = f"Sample content for {name}\nCreated at {now.strftime('%Y-%m-%d %H:%M:%S')}"
         
         # Allocate blocks for the file
         try:
@@ -754,32 +1079,26 @@ class FileSystem:
         except Exception as e:
             return f"touch: cannot create file: {str(e)}"
         
-        current_dir.children.append(new_file)
-        current_dir.modified = datetime.now()
+        self._attach(current_dir, new_file)
+        current_dir.modified = now
         
-        self._update_disk_usage()
-        return f"File '{name}' created ({self._format_size(file_size)})"
+        self._add_size(current_dir, file_size)
+        self._log("touch", now, name, file_size, content)
+        return f"File '{name}' created ({format_size(file_size)})"
     
     def rm(self, name, recursive=False):
         """Remove file or directory"""
         if not name:
             return "rm: missing operand"
             
-        current_dir = self._get_current_directory()
+        current_dir = self.current_dir_node
         if not current_dir:
             return "rm: failed to remove"
             
         # Find the target
-        target_index = None
-        for i, child in enumerate(current_dir.children):
-            if child.name == name:
-                target_index = i
-                break
-                
-        if target_index is None:
+        target = current_dir.children.get(name)
+        if target is None:
             return f"rm: cannot remove '{name}': No such file or directory"
-            
-        target = current_dir.children[target_index]
         
         # Check if it's a directory and not empty
         if target.type == "directory" and target.children and not recursive:
@@ -793,32 +1112,45 @@ class FileSystem:
             self._free_blocks_recursive(target)
             
         # Remove the target
-        current_dir.children.pop(target_index)
-        current_dir.modified = datetime.now()
+        self._detach(current_dir, name)
+        now = self._now()
+        current_dir.modified = now
         
-        self._update_disk_usage()
+        self._add_size(current_dir, -target.size)
+        self._log("rm", now, name, recursive)
         return f"'{name}' removed"
     
     def _free_blocks_recursive(self, dir_node):
-        """Recursively free blocks for all files in a directory"""
-        if not dir_node.children:
-            return
-            
-        for child in dir_node.children:
-            if child.type == "file":
-                self._free_blocks(child)
-            elif child.type == "directory":
-                self._free_blocks_recursive(child)
+        """Free blocks for all files below a directory (explicit-stack walk)"""
+        # Gather every file's blocks first and release them in one batch
+        freed = []
+        stack = [dir_node]
+        while stack:
+            node = stack.pop()
+            if not node.children:
+                continue
+                
+            for child in node.children.values():
+                if child.type == "file":
+                    if child.blocks:
+                        freed.extend(child.blocks)
+                        child.blocks = []
+                        child.start_block = None
+                elif child.type == "directory":
+                    stack.append(child)
+        
+        if freed:
+            self._release_blocks(freed)
     
     def df(self):
         """Show disk usage"""
-        used_mb = self.used_size / (1024 * 1024)
-        total_mb = self.total_size / (1024 * 1024)
-        free_mb = (self.total_size - self.used_size) / (1024 * 1024)
+        used_mb = self.used_size * INV_MB
+        total_mb = self.total_size * INV_MB
+        free_mb = (self.total_size - self.used_size) * INV_MB
         used_percent = (self.used_size / self.total_size) * 100
         
         return [
-            "Filesystem     Size  Used Avail Use%",
+            DF_HEADER,
             f"/dev/sda1      {total_mb:.1f}M  {used_mb:.1f}M  {free_mb:.1f}M  {used_percent:.1f}%"
         ]
     
@@ -829,44 +1161,114 @@ class FileSystem:
             result = ["/"]
         else:
             result = []
-            
-        if node.type == "directory" and node.children:
-            for i, child in enumerate(node.children):
-                is_last = i == len(node.children) - 1
-                size_info = f" ({self._format_size(child.size)})" if child.type == "file" else ""
-                result.append(f"{prefix}{'└── ' if is_last else '├── '}{child.name}{size_info}")
-                
-                if child.type == "directory":
-                    new_prefix = prefix + ("    " if is_last else "│   ")
-                    child_result = self.tree(child, new_prefix)
-                    result.extend(child_result)
+        
+        # Explicit-stack pre-order walk of (node, prefix, is_last); children are
+        # pushed in reverse so they pop in order
+        stack = []
+        push, extend, pop, append = stack.append, stack.extend, stack.pop, result.append
+        
+        def push_children(parent, parent_prefix):
+            if parent.type == "directory" and parent.children:
+                # The last child goes in first (at the bottom) and is the only one flagged
+                children = reversed(parent.children.values())
+                push((next(children), parent_prefix, True))
+                extend((child, parent_prefix, False) for child in children)
+        
+        push_children(node, prefix)
+        while stack:
+            child, child_prefix, is_last = pop()
+            if child.type == "file":
+                append(f"{child_prefix}{TREE_BRANCHES[is_last]}{child.name} ({format_size(child.size)})")
+            else:
+                append(child_prefix + TREE_BRANCHES[is_last] + child.name)
+                push_children(child, child_prefix + TREE_INDENTS[is_last])
                     
         return result
     
-    def save_state(self, filename="filesystem_state.json"):
-        """Save the file system state to a JSON file"""
-        state = {
-            "root": self.root.to_dict(),
+    def enable_wal(self, filename="filesystem_state.msgpack"):
+        """Append every mutation to <filename>.wal until the next save_state of that file"""
+        # Only one log is written at a time; close the one enabled before
+        if self._wal is not None:
+            self._wal.close()
+        self._wal = open(filename + WAL_SUFFIX, "ab", buffering=0)
+        return f"Write-ahead log enabled at {filename + WAL_SUFFIX}"
+    
+    def _now(self):
+        """Current time, or the logged time of the mutation being replayed"""
+        return self._replay_now or datetime.now()
+    
+    def _log(self, op, timestamp, *args):
+        """Append a mutation (method name, working directory, time, arguments) to the write-ahead log,
+        and note the directory entry it changed while a store collects them"""
+        if self._wal is not None:
+            logged_at = timestamp.isoformat() if timestamp is not None else None
+            self._wal.write(orjson.dumps([op, self.current_path_str, logged_at, *args]) + b"\n")
+        if self._changed_entries is not None and op in ENTRY_OPS:
+            self._changed_entries.append((op, self.current_dir_node, args[0]))
+    
+    def _replay_wal(self, filename):
+        """Re-run the mutations logged after the snapshot was written"""
+        wal, self._wal = self._wal, None
+        try:
+            with open(filename, "rb") as f:
+                for line in f:
+                    try:
+                        op, cwd, logged_at, *args = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        break  # Torn final record from an interrupted write
+                    self.cd(cwd)
+                    # Replayed nodes get the times (and generated content) of the original run
+                    self._replay_now = datetime.fromisoformat(logged_at) if logged_at else None
+                    getattr(self, op)(*args)
+        finally:
+            self._replay_now = None
+            self._wal = wal
+    
+    def save_state(self, filename="filesystem_state.msgpack"):
+        """Save the file system state to a MessagePack file (a checkpoint when the WAL is enabled)"""
+        fields = {
             "current_path": self.current_path,
             "total_size": self.total_size,
             "used_size": self.used_size
         }
+        try:
+            data = STATE_FILE_MAGIC + ormsgpack.packb({"root": self.root.to_dict(), **fields})
+        except (TypeError, RecursionError):
+            # Too deep for ormsgpack: write the legacy JSON format (load_state reads both)
+            # with the non-recursive encoder
+            data = b'{"root":' + tree_to_json(self.root, FileSystemNode.own_dict) + b"," + orjson.dumps(fields)[1:]
+        
+        # Write a temporary file and swap it in, so a crash never leaves a half-written snapshot
+        with open(filename + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + ".tmp", filename)
         
-        with open(filename, "w") as f:
-            json.dump(state, f, indent=2)
+        # Everything logged so far is in the snapshot now
+        if self._wal is not None and self._wal.name == filename + WAL_SUFFIX:
+            self._wal.truncate(0)
             
         return f"File system state saved to {filename}"
     
-    def load_state(self, filename="filesystem_state.json"):
-        """Load the file system state from a JSON file"""
+    def load_state(self, filename="filesystem_state.msgpack"):
+        """Load the file system state from a MessagePack (or legacy JSON) file"""
         try:
-            with open(filename, "r") as f:
-                state = json.load(f)
+            with open(filename, "rb") as f:
+                data = f.read()
+            if data.startswith(STATE_FILE_MAGIC):
+                state = ormsgpack.unpackb(memoryview(data)[len(STATE_FILE_MAGIC):])
+            else:
+                state = orjson.loads(data)
                 
-            self.root = FileSystemNode.from_dict(state["root"])
-            self.current_path = state["current_path"]
             self.total_size = state["total_size"]
-            self.used_size = state["used_size"]
+            self.total_blocks = math.ceil(self.total_size / BLOCK_SIZE)
+            # Blocks allocated before the load belong to the old tree; the snapshot holds none
+            self._restore(FileSystemNode.from_dict(state["root"]), state["current_path"], state["used_size"])
+            if os.path.exists(filename + WAL_SUFFIX):
+                self._replay_wal(filename + WAL_SUFFIX)
+            self._state_dirty = True
+            self._version += 1
             
             return f"File system state loaded from {filename}"
         except Exception as e:
@@ -880,18 +1282,27 @@ class FileSystem:
             
         results = []
         
-        def search(node, current_path):
-            if node.name == name:
-                results.append(current_path + "/" + node.name if current_path else "/" + node.name)
+        # Explicit-stack pre-order walk of (node, parent path); a node's own path is only
+        # built when it matches or has children to pass it on to
+        name = sys.intern(name)
+        stack = deque([(start_node, "")])
+        # Bound methods hoisted out of the loop
+        pop, extend, append = stack.pop, stack.extend, results.append
+        while stack:
+            node, current_path = pop()
+            node_name = node.name
+            is_match = node_name == name
+            has_children = node.type == "directory" and node.children
+            if not (is_match or has_children):
+                continue
+                
+            full_path = current_path + "/" + node_name if current_path else "/" + node_name
+            if is_match:
+                append(full_path)
                 
-            if node.type == "directory" and node.children:
-                for child in node.children:
-                    child_path = current_path + "/" + node.name if current_path else "/" + node.name
-                    if child_path == "//":
-                        child_path = ""
-                    search(child, child_path)
-        
-        search(start_node, "")
+            if has_children:
+                child_path = "" if full_path == "//" else full_path
+                extend((child, child_path) for child in reversed(node.children.values()))
         
         if not results:
             return f"No files found matching '{name}'"
@@ -0,0 +1,259 @@
+import secrets
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional, Protocol
+
+import ormsgpack
+
+from file_system import FileSystem, FileSystemNode
+
+class FileSystemStore(Protocol):
+    """Where the API keeps its FileSystem between requests.
+
+    The file system is only handed out inside read() and write(), which exclude
+    writers, so anything serialized from it must be built inside the block.
+    """
+
+    # Random token identifying this store's state history (versions restart with it)
+    store_id: str
+
+    def read(self):
+        """Context manager yielding the latest file system for a read-only request"""
+        ...
+
+    def write(self):
+        """Context manager yielding the file system for one mutation"""
+        ...
+
+    def replace(self, fs: FileSystem) -> None:
+        """Swap in a new file system (used by reset), continuing the old one's version"""
+        ...
+
+    def peek_version(self) -> Optional[int]:
+        """Mutation counter of the latest state if known without blocking, else None"""
+        ...
+
+class LocalFSStore:
+    """Keeps the file system in process memory (single worker, many threadpool threads)"""
+
+    def __init__(self):
+        self.fs = FileSystem()
+        # A new process builds a new tree (default file sizes are random)
+        self.store_id = secrets.token_hex(8)
+        # Mutations and serializing reads run one at a time
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def read(self) -> Iterator[FileSystem]:
+        with self._lock:
+            yield self.fs
+
+    @contextmanager
+    def write(self) -> Iterator[FileSystem]:
+        with self._lock:
+            yield self.fs
+
+    def replace(self, fs):
+        with self._lock:
+            fs._version = self.fs._version + 1
+            self.fs = fs
+
+    def peek_version(self):
+        # A plain attribute read; a write in progress bumps it only once its mutation is done
+        return self.fs._version
+
+# Escape "/" (and the escape character itself) in names, so node keys stay unambiguous
+def _key_part(name):
+    return name.replace("%", "%25").replace("/", "%2F")
+
+# Helper function to list a node and its ancestors with their keys, root ("") first
+def _keyed_ancestors(node):
+    chain = []
+    while node is not None:
+        chain.append(node)
+        node = node.parent
+    chain.reverse()
+    
+    key = ""
+    keyed = [(chain[0], key)]
+    for ancestor in chain[1:]:
+        key += "/" + _key_part(ancestor.name)
+        keyed.append((ancestor, key))
+    return keyed
+
+class SqliteFSStore:
+    """Shares the file system between worker processes through a SQLite file.
+
+    Each node is one row keyed by its escaped path (rowid order = creation order),
+    next to a single row of file-system fields and a version number. A mutation
+    runs inside an immediate transaction and only rewrites the rows of the entries
+    it changed and their ancestors. Each worker keeps its own in-memory tree and
+    only rebuilds it when the stored version moved on, so the per-worker serialized
+    state cache stays valid until another worker writes.
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fs_meta ("
+            "id INTEGER PRIMARY KEY CHECK (id = 1), store_id TEXT NOT NULL, "
+            "version INTEGER NOT NULL, meta BLOB NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS fs_nodes (key TEXT PRIMARY KEY, record BLOB NOT NULL)")
+        # One connection per worker, shared by the threadpool
+        self._lock = threading.Lock()
+        self._fs: Optional[FileSystem] = None
+        self._version = 0
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT store_id FROM fs_meta WHERE id = 1").fetchone()
+                if row is None:
+                    # Generated with the database, so every worker (and restart) on this file shares it
+                    self.store_id = secrets.token_hex(8)
+                    self._fs = FileSystem()
+                    self._save()
+                else:
+                    self.store_id = row[0]
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                self._fs = None
+                raise
+
+    def _refresh(self):
+        """Rebuild the tree if another worker changed it (caller holds the lock)"""
+        version = self._conn.execute("SELECT version FROM fs_meta WHERE id = 1").fetchone()[0]
+        if version != self._version or self._fs is None:
+            self._fs = self._load()
+            self._version = version
+
+    def _load(self):
+        """Build a file system from the stored rows, parents before their children"""
+        meta = ormsgpack.unpackb(self._conn.execute("SELECT meta FROM fs_meta WHERE id = 1").fetchone()[0])
+        fs = FileSystem(meta["total_size"], sample_data=False)
+        nodes = {}
+        for key, record in self._conn.execute("SELECT key, record FROM fs_nodes ORDER BY rowid"):
+            if not key:
+                nodes[key] = FileSystemNode.from_record(ormsgpack.unpackb(record))
+                continue
+            parent = nodes[key.rpartition("/")[0]]
+            node = FileSystemNode.from_record(ormsgpack.unpackb(record), parent)
+            parent.add_child(node)
+            nodes[key] = node
+            
+        fs.set_allocation_strategy(meta["allocation_strategy"])
+        fs._restore(nodes[""], meta["current_path"], meta["used_size"])
+        fs._version = meta["version"]
+        return fs
+
+    def _save(self, changes=None):
+        """Write the rows of the changed entries (every row when changes is None) and bump the version"""
+        fs = self._fs
+        if changes is None:
+            self._conn.execute("DELETE FROM fs_nodes")
+            rows = []
+            stack = [(fs.root, "")]
+            while stack:
+                node, key = stack.pop()
+                rows.append((key, ormsgpack.packb(node.to_record())))
+                if node.children:
+                    stack.extend((child, key + "/" + _key_part(child.name)) for child in reversed(node.children.values()))
+            self._conn.executemany("INSERT INTO fs_nodes (key, record) VALUES (?, ?)", rows)
+        else:
+            # Replay the changes in order: removals drop their subtree (and anything queued
+            # under it), everything else queues the entry and its ancestors for an upsert
+            upserts = {}
+            removed = []
+            for op, directory, name in changes:
+                keyed = _keyed_ancestors(directory)
+                key = keyed[-1][1] + "/" + _key_part(name)
+                upserts.update((k, node) for node, k in keyed)
+                if op == "rm":
+                    removed.append(key)
+                    subtree = key + "/"
+                    for queued in [k for k in upserts if k == key or k.startswith(subtree)]:
+                        del upserts[queued]
+                else:
+                    child = directory.children.get(name)
+                    if child is not None:
+                        upserts[key] = child
+                        
+            # Key ranges [key + "/", key + "0") hold exactly the descendants ("0" follows "/")
+            self._conn.executemany(
+                "DELETE FROM fs_nodes WHERE key = ? OR (key >= ? AND key < ?)",
+                [(key, key + "/", key + "0") for key in removed]
+            )
+            self._conn.executemany(
+                "INSERT INTO fs_nodes (key, record) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET record = excluded.record",
+                [(key, ormsgpack.packb(node.to_record())) for key, node in upserts.items()]
+            )
+            
+        meta = {
+            "total_size": fs.total_size,
+            "used_size": fs.used_size,
+            "current_path": fs.current_path,
+            "allocation_strategy": fs.allocation_strategy,
+            "version": fs._version
+        }
+        self._version += 1
+        self._conn.execute(
+            "INSERT OR REPLACE INTO fs_meta (id, store_id, version, meta) VALUES (1, ?, ?, ?)",
+            (self.store_id, self._version, ormsgpack.packb(meta))
+        )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """Hold the lock and an immediate transaction around an up-to-date tree"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh()
+                yield
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                # The in-memory copy may be half-mutated, reload it next time
+                self._fs = None
+                raise
+
+    @contextmanager
+    def read(self) -> Iterator[FileSystem]:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._refresh()
+                yield self._fs
+            finally:
+                self._conn.execute("COMMIT")
+
+    @contextmanager
+    def write(self) -> Iterator[FileSystem]:
+        with self._transaction():
+            fs = self._fs
+            fs._changed_entries = []
+            try:
+                yield fs
+            finally:
+                changes, fs._changed_entries = fs._changed_entries, None
+            self._save(changes)
+
+    def replace(self, fs):
+        with self._transaction():
+            fs._version = self._fs._version + 1
+            self._fs = fs
+            self._save()
+
+    def peek_version(self):
+        # Another worker may have written, only the database can tell
+        return None
+
+def open_store(path=None) -> FileSystemStore:
+    """Open a SQLite-backed store when a path is given, otherwise an in-process one"""
+    if path:
+        return SqliteFSStore(path)
+    return LocalFSStore()